@@ -1,15 +1,40 @@
 import base64
-import vertexai
-from fastapi import FastAPI, HTTPException
+import asyncio
+import hashlib
+from fastapi import FastAPI, File, Form, HTTPException, Response, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List
-from fastapi.responses import StreamingResponse, JSONResponse
-import asyncio
-import re
+from typing import List, Optional
+from fastapi.responses import ORJSONResponse
+from sse_starlette.sse import EventSourceResponse
 from google.cloud import texttospeech
 
-from vertexai.generative_models import GenerativeModel, Part, Content, HarmCategory, HarmBlockThreshold
+from vertexai.generative_models import Part, Content, HarmCategory, HarmBlockThreshold
+
+from services import (
+    ANALYZER_MODEL,
+    VISION_MODEL,
+    CHAT_MODEL,
+    VOICE_BY_LANGUAGE,
+    DEFAULT_VOICE,
+    MD_STRIP_TABLE,
+    SENTENCE_SPLIT_RE,
+    tts_client,
+    tts_synth_limiter,
+    strip_wav_header,
+    tts_cache_key,
+    tts_cache_get,
+    tts_cache_put,
+    get_analysis_parts,
+    coalesce,
+    buffered,
+    chat_session_get,
+    chat_session_put,
+    embed_question,
+    is_cacheable_question,
+    chat_answer_get,
+    chat_answer_put,
+)
 
 # --- Pydantic Models ---
 class AnalysisRequest(BaseModel):
@@ -32,13 +57,14 @@ class ChatRequest(BaseModel):
     history: List[ChatMessage]
     question: str
     language: str
+    session_id: Optional[str] = None
 
 class TTSRequest(BaseModel):
     text: str
     language: str
 
 # --- FastAPI App ---
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # --- CORS Middleware ---
 app.add_middleware(
@@ -49,11 +75,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# --- Vertex AI & TTS Initialization ---
-PROJECT_ID = "genai-471305"
-LOCATION = "us-central1"
-vertexai.init(project=PROJECT_ID, location=LOCATION)
-tts_client = texttospeech.TextToSpeechClient()
+# SSE framing is handled by EventSourceResponse; these headers keep proxies
+# (nginx in particular) from gzip-buffering the stream before the client sees it.
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+    "Content-Encoding": "identity",
+}
 
 # --- API Endpoints ---
 
@@ -66,81 +94,76 @@ async def analyze_document_stream(request: AnalysisRequest):
     """Analyzes text and streams a structured markdown summary back."""
     async def generate():
         try:
-            model = GenerativeModel("gemini-2.5-flash")
-            prompt = f"""
-            Act as a friendly personal legal adviser. Your goal is to help a common person understand this document.
-            Your response must be in {request.language}. All explanations must be **very simple, short, and easy to understand.** Avoid legal jargon completely.
-            Your response must be in Markdown format and strictly follow this structure:
-            First, provide a "### Summary".
-            Second, provide a "### Key Clauses Explained".
-            Third, provide a "### My Advice To You".
-            Under "Key Clauses Explained", list each important clause. For each clause:
-            - Start the line with a `*`.
-            - Use a 🔴 emoji for high-risk, 🟡 for medium-risk, and 🟢 for safe clauses.
-            - Make the clause title bold (e.g., **Ending the Agreement**).
-            - After the title, provide a one-sentence explanation of what it means in plain language.
-            Under "My Advice To You", give short, practical, bullet-pointed advice that a regular person can easily act on.
-            Document:
-            ---
-            {request.document}
-            ---
-            """
-            stream = model.generate_content(prompt, stream=True)
-            for chunk in stream:
-                if hasattr(chunk, 'text'):
-                    yield chunk.text
-                    await asyncio.sleep(0.01)
+            contents = get_analysis_parts(request.document, request.language)
+            stream = await ANALYZER_MODEL.generate_content_async(contents, stream=True)
+            async for text in buffered(coalesce(stream)):
+                yield {"data": text}
         except Exception as e:
             print(f"Streaming analysis error: {e}")
-            yield "An error occurred during analysis."
-    return StreamingResponse(generate(), media_type="text/event-stream")
+            yield {"data": "An error occurred during analysis."}
+    return EventSourceResponse(generate(), headers=SSE_HEADERS)
 
-@app.post("/analyze-image-stream")
-async def analyze_image_stream(request: ImageRequest):
-    """Extracts text from an image and immediately streams the analysis."""
+async def _image_analysis_events(image_bytes, mime_type, language):
+    """Streams OCR progress and the document analysis for an in-memory image."""
+    # One generator, one try/except: OCR runs inside it so the client gets a
+    # first byte right away instead of waiting out the whole extraction.
     try:
-        model_vision = GenerativeModel("gemini-2.5-flash")
-        image_bytes = base64.b64decode(request.image_data)
-        image_part = Part.from_data(data=image_bytes, mime_type="image/jpeg")
+        yield {"data": "### Extracting text from the image…\n\n"}
+        image_part = Part.from_data(data=image_bytes, mime_type=mime_type)
         prompt_parts = [image_part, "Extract all text from this image. Only return the extracted text."]
-        ocr_response = model_vision.generate_content(prompt_parts)
+        ocr_response = await VISION_MODEL.generate_content_async(prompt_parts)
         document_text = ocr_response.text
         if not document_text.strip():
-             async def no_text_generator():
-                 yield "### Summary\n\nCould not find any text in the image. Please try another one."
-             return StreamingResponse(no_text_generator(), media_type="text/event-stream")
+            yield {"data": "### Summary\n\nCould not find any text in the image. Please try another one."}
+            return
+        contents = get_analysis_parts(document_text, language)
+        stream = await ANALYZER_MODEL.generate_content_async(contents, stream=True)
+        async for text in buffered(coalesce(stream)):
+            yield {"data": text}
     except Exception as e:
-        print(f"Image processing error: {e}")
-        async def error_generator():
-            yield "### Summary\n\nAn error occurred while processing the image."
-        return StreamingResponse(error_generator(), media_type="text/event-stream")
+        print(f"Image analysis error: {e}")
+        yield {"data": "### Summary\n\nAn error occurred while analyzing the image."}
 
-    async def generate_analysis():
-        try:
-            model_text = GenerativeModel("gemini-2.5-flash")
-            prompt = f"""
-            Act as a friendly personal legal adviser...
-            # (Same prompt as /analyze-text-stream)
-            Document:
-            ---
-            {document_text}
-            ---
-            """
-            stream = model_text.generate_content(prompt, stream=True)
-            for chunk in stream:
-                if hasattr(chunk, 'text'):
-                    yield chunk.text
-                    await asyncio.sleep(0.01)
-        except Exception as e:
-            print(f"Streaming analysis error from image: {e}")
-            yield "An error occurred during analysis."
-    return StreamingResponse(generate_analysis(), media_type="text/event-stream")
+@app.post("/analyze-image-stream")
+async def analyze_image_stream(request: ImageRequest):
+    """Extracts text from a base64-encoded image and immediately streams the analysis."""
+    try:
+        image_bytes = base64.b64decode(request.image_data)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid base64 image data.")
+    return EventSourceResponse(_image_analysis_events(image_bytes, "image/jpeg", request.language),
+                               headers=SSE_HEADERS)
+
+@app.post("/analyze-image-stream-binary")
+async def analyze_image_stream_binary(file: UploadFile = File(...), language: str = Form("English")):
+    """Accepts a raw multipart image upload, skipping base64 inflation entirely."""
+    image_bytes = await file.read()
+    mime_type = file.content_type or "image/jpeg"
+    return EventSourceResponse(_image_analysis_events(image_bytes, mime_type, language),
+                               headers=SSE_HEADERS)
 
 @app.post("/chat-with-document")
 async def chat_with_document(request: ChatRequest):
     """Handles follow-up questions about a document using a non-streaming response to prevent duplication."""
     try:
-        system_prompt = f"""
+        # Rephrased questions about the same document are common; check the
+        # semantic cache before spending a full Gemini round-trip. Short,
+        # context-dependent questions bypass the cache entirely.
+        document_sha = hashlib.sha256(request.document.encode()).hexdigest()
+        question_vec = None
+        if is_cacheable_question(request.question):
+            question_vec = await embed_question(request.question)
+        if question_vec is not None:
+            cached_answer = chat_answer_get(document_sha, request.language, question_vec)
+            if cached_answer is not None:
+                return {"response": cached_answer}
+
+        # The language is part of the cache key: the system prompt bakes it in,
+        # so switching languages mid-chat must miss and rebuild the session.
+        session_key = f"{request.session_id}|{request.language}" if request.session_id else None
+        chat = chat_session_get(session_key) if session_key else None
+        if chat is None:
+            system_prompt = f"""
         You are a friendly and practical personal legal adviser based in Vadodara, Gujarat, India.
         Your primary goal is to help users understand their legal documents.
         Here are your rules:
@@ -156,18 +179,27 @@ async def chat_with_document(request: ChatRequest):
         {request.document}
         ---
         """
-        model_with_system_prompt = GenerativeModel("gemini-2.5-flash", system_instruction=system_prompt)
-        history_content = [Content(role=msg.role, parts=[Part.from_text(part.text) for part in msg.parts]) for msg in request.history]
-        chat = model_with_system_prompt.start_chat(history=history_content)
-        
+            # The system prompt varies per request (language, document), so feed it as the
+            # opening turn of the history instead of baking it into a per-request model.
+            history_content = [
+                Content(role="user", parts=[Part.from_text(system_prompt)]),
+                Content(role="model", parts=[Part.from_text("Understood. I will follow these rules.")]),
+            ]
+            history_content += [Content(role=msg.role, parts=[Part.from_text(part.text) for part in msg.parts]) for msg in request.history]
+            chat = CHAT_MODEL.start_chat(history=history_content)
+            if session_key:
+                chat_session_put(session_key, chat)
+
         # --- FIX: Generate the full response, don't stream ---
-        response = chat.send_message(request.question, stream=False)
-        
+        response = await chat.send_message_async(request.question, stream=False)
+
         if hasattr(response, 'text'):
-            return JSONResponse(content={"response": response.text})
+            if question_vec is not None:
+                chat_answer_put(document_sha, request.language, question_vec, response.text)
+            return {"response": response.text}
         else:
             # Handle cases where the response might be empty or blocked
-            return JSONResponse(content={"response": "I'm sorry, I couldn't generate a response for that."})
+            return {"response": "I'm sorry, I couldn't generate a response for that."}
 
     except Exception as e:
         print(f"Chat error: {e}")
@@ -177,26 +209,47 @@ async def chat_with_document(request: ChatRequest):
 async def text_to_speech_gcp(request: TTSRequest):
     """Generates speech using Google Cloud Text-to-Speech API."""
     try:
-        language_mapping = {
-            "English": "en-IN", "Hindi": "hi-IN", "Gujarati": "gu-IN",
-            "Kannada": "kn-IN", "Marathi": "mr-IN", "Tamil": "ta-IN", "Telugu": "te-IN",
-        }
-        lang_code = language_mapping.get(request.language, "en-IN")
+        lang_code, voice_name = VOICE_BY_LANGUAGE.get(request.language, DEFAULT_VOICE)
+        clean_text = request.text.translate(MD_STRIP_TABLE).strip()
+        if not clean_text:
+            raise HTTPException(status_code=400, detail="No speakable text provided.")
+
+        cache_key = tts_cache_key(lang_code, voice_name, clean_text)
+        cached_audio = tts_cache_get(cache_key)
+        if cached_audio is not None:
+            return Response(content=cached_audio, media_type="audio/l16;rate=24000",
+                            headers={"X-TTS-Lang": lang_code})
 
-        synthesis_input = texttospeech.SynthesisInput(text=request.text)
         voice = texttospeech.VoiceSelectionParams(
             language_code=lang_code,
-            ssml_gender=texttospeech.SsmlVoiceGender.NEUTRAL
+            name=voice_name
         )
         audio_config = texttospeech.AudioConfig(
             audio_encoding=texttospeech.AudioEncoding.LINEAR16,
             sample_rate_hertz=24000
         )
-        response = tts_client.synthesize_speech(
-            input=synthesis_input, voice=voice, audio_config=audio_config
-        )
-        audio_data = base64.b64encode(response.audio_content).decode('utf-8')
-        return {"audio_data": audio_data, "mime_type": "audio/L16;rate=24000"}
+        # Synthesis latency grows with text length, so split on sentence boundaries
+        # and synthesize the sentences concurrently, bounded by the shared limiter.
+        sentences = [s for s in SENTENCE_SPLIT_RE.split(clean_text) if s.strip()]
+        if not sentences:
+            sentences = [clean_text]
+
+        async def synthesize(sentence):
+            async with tts_synth_limiter:
+                return await tts_client.synthesize_speech(
+                    input=texttospeech.SynthesisInput(text=sentence),
+                    voice=voice,
+                    audio_config=audio_config,
+                )
+
+        responses = await asyncio.gather(*[synthesize(s) for s in sentences])
+        # Strip each response's WAV container so the joined buffer is pure PCM.
+        audio_content = b"".join(strip_wav_header(r.audio_content) for r in responses)
+        tts_cache_put(cache_key, audio_content)
+        # Return the raw PCM directly: no base64 inflation and no jsonable_encoder pass.
+        return Response(content=audio_content, media_type="audio/l16;rate=24000",
+                        headers={"X-TTS-Lang": lang_code})
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error in text-to-speech: {e}")
-
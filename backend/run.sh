@@ -0,0 +1,16 @@
+#!/usr/bin/env bash
+# Production entrypoint. The app is almost entirely IO-bound on Vertex AI and
+# TTS gRPC, so run one worker per core on uvloop with the httptools parser
+# (both ship with uvicorn[standard]) and keep connections alive for the many
+# concurrent SSE streams.
+set -euo pipefail
+cd "$(dirname "$0")"
+
+exec uvicorn main:app \
+    --host 0.0.0.0 \
+    --port "${PORT:-8000}" \
+    --loop uvloop \
+    --http httptools \
+    --workers "$(nproc)" \
+    --backlog 2048 \
+    --timeout-keep-alive 30
@@ -0,0 +1,309 @@
+import asyncio
+import hashlib
+import math
+import re
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import vertexai
+from google.cloud import texttospeech
+from vertexai.generative_models import GenerativeModel, Part
+from vertexai.language_models import TextEmbeddingModel
+
+# --- Vertex AI & TTS Initialization ---
+PROJECT_ID = "genai-471305"
+LOCATION = "us-central1"
+vertexai.init(project=PROJECT_ID, location=LOCATION)
+tts_client = texttospeech.TextToSpeechAsyncClient()
+
+# --- Gemini Models ---
+# Constructed once at import time so every request reuses the same warm client
+# state and gRPC channel instead of building a fresh model per call.
+ANALYZER_MODEL = GenerativeModel("gemini-2.5-flash")
+VISION_MODEL = GenerativeModel("gemini-2.5-flash")
+CHAT_MODEL = GenerativeModel("gemini-2.5-flash")
+EMBEDDING_MODEL = TextEmbeddingModel.from_pretrained("text-embedding-004")
+
+# --- Language Support ---
+SUPPORTED_LANGUAGES = ("English", "Hindi", "Gujarati", "Kannada", "Marathi", "Tamil", "Telugu")
+
+# (language_code, voice_name) per supported language, resolved once at import
+# time so the request path is a single dict lookup. Names must exist in the
+# API's voices.list for their locale; te-IN ships no Wavenet voices, so Telugu
+# uses its Standard voice.
+VOICE_BY_LANGUAGE = {
+    "English": ("en-IN", "en-IN-Wavenet-A"),
+    "Hindi": ("hi-IN", "hi-IN-Wavenet-A"),
+    "Gujarati": ("gu-IN", "gu-IN-Wavenet-A"),
+    "Kannada": ("kn-IN", "kn-IN-Wavenet-A"),
+    "Marathi": ("mr-IN", "mr-IN-Wavenet-A"),
+    "Tamil": ("ta-IN", "ta-IN-Wavenet-A"),
+    "Telugu": ("te-IN", "te-IN-Standard-A"),
+}
+DEFAULT_VOICE = VOICE_BY_LANGUAGE["English"]
+
+# --- Analysis Prompt ---
+ANALYSIS_PROMPT_TEMPLATE = """
+Act as a friendly personal legal adviser. Your goal is to help a common person understand this document.
+Your response must be in {language}. All explanations must be **very simple, short, and easy to understand.** Avoid legal jargon completely.
+Your response must be in Markdown format and strictly follow this structure:
+First, provide a "### Summary".
+Second, provide a "### Key Clauses Explained".
+Third, provide a "### My Advice To You".
+Under "Key Clauses Explained", list each important clause. For each clause:
+- Start the line with a `*`.
+- Use a 🔴 emoji for high-risk, 🟡 for medium-risk, and 🟢 for safe clauses.
+- Make the clause title bold (e.g., **Ending the Agreement**).
+- After the title, provide a one-sentence explanation of what it means in plain language.
+Under "My Advice To You", give short, practical, bullet-pointed advice that a regular person can easily act on.
+Document:
+---
+{document}
+---
+"""
+
+# Pre-render the template per language once, split around the document slot, so the
+# request path only concatenates the document instead of re-formatting ~1 KB of text.
+_PROMPT_PARTS_BY_LANG = {
+    lang: tuple(ANALYSIS_PROMPT_TEMPLATE.format(language=lang, document="__DOC__").split("__DOC__"))
+    for lang in SUPPORTED_LANGUAGES
+}
+
+def get_analysis_prompt(document: str, language: str) -> str:
+    """Builds the analysis prompt, using the pre-rendered prefix for known languages."""
+    parts = _PROMPT_PARTS_BY_LANG.get(language)
+    if parts is None:
+        return ANALYSIS_PROMPT_TEMPLATE.format(language=language, document=document)
+    head, tail = parts
+    return head + document + tail
+
+# Pre-built Part objects for the fixed head/tail: their protobuf payloads are
+# encoded once at import time and shared across requests, so only the document
+# itself is converted per call.
+_PROMPT_PART_OBJS_BY_LANG = {
+    lang: (Part.from_text(head), Part.from_text(tail))
+    for lang, (head, tail) in _PROMPT_PARTS_BY_LANG.items()
+}
+
+def get_analysis_parts(document: str, language: str) -> list:
+    """Returns the analysis prompt as a Part list, reusing the cached head/tail."""
+    parts = _PROMPT_PART_OBJS_BY_LANG.get(language)
+    if parts is None:
+        return [Part.from_text(get_analysis_prompt(document, language))]
+    head, tail = parts
+    return [head, Part.from_text(document), tail]
+
+# --- TTS Text Preparation ---
+# Both built once: str.translate runs a single C pass over the text, and the
+# compiled regex avoids re-parsing the pattern on every request.
+MD_STRIP_TABLE = str.maketrans("", "", "*_`#")
+SENTENCE_SPLIT_RE = re.compile(r'(?<=[.?!])\s+')
+
+# Cap on concurrent synthesize RPCs: long analyses split into dozens of
+# sentences, and an unbounded burst trips API quotas.
+tts_synth_limiter = asyncio.Semaphore(8)
+
+def strip_wav_header(audio_content: bytes) -> bytes:
+    """Returns the bare PCM samples from a LINEAR16 synthesize_speech response.
+
+    The API wraps LINEAR16 audio in a WAV container, so concatenating responses
+    as-is would embed a RIFF header (heard as a click) at every join. Locate
+    the data chunk instead of assuming a fixed 44-byte header.
+    """
+    if not audio_content.startswith(b"RIFF"):
+        return audio_content
+    idx = audio_content.find(b"data", 12)
+    if idx == -1:
+        return audio_content
+    return audio_content[idx + 8:]
+
+# --- TTS Cache ---
+# Identical texts (clause explanations, section headers, error messages) are requested
+# repeatedly, so cache the synthesized PCM on disk plus a small in-memory LRU to avoid
+# re-hitting the TTS API for the same utterance.
+TTS_CACHE_DIR = Path(__file__).parent / "tts_cache"
+TTS_MEMORY_CACHE_SIZE = 1024
+_tts_memory_cache = OrderedDict()
+
+def tts_cache_key(lang_code: str, voice_name: str, text: str) -> str:
+    return hashlib.sha256(f"{lang_code}|{voice_name}|LINEAR16|24000|{text}".encode()).hexdigest()
+
+def _tts_cache_path(key: str) -> Path:
+    return TTS_CACHE_DIR / key[:2] / f"{key}.pcm"
+
+def tts_cache_get(key: str):
+    """Returns cached raw PCM bytes for the key, or None on a miss."""
+    if key in _tts_memory_cache:
+        _tts_memory_cache.move_to_end(key)
+        return _tts_memory_cache[key]
+    path = _tts_cache_path(key)
+    if path.is_file():
+        audio_content = path.read_bytes()
+        tts_cache_put(key, audio_content, write_disk=False)
+        return audio_content
+    return None
+
+def tts_cache_put(key: str, audio_content: bytes, write_disk: bool = True):
+    _tts_memory_cache[key] = audio_content
+    _tts_memory_cache.move_to_end(key)
+    while len(_tts_memory_cache) > TTS_MEMORY_CACHE_SIZE:
+        _tts_memory_cache.popitem(last=False)
+    if write_disk:
+        try:
+            path = _tts_cache_path(key)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(audio_content)
+        except OSError as e:
+            print(f"TTS cache write error: {e}")
+
+# --- Chat Session Cache ---
+# Rebuilding the Vertex ChatSession from the full history on every turn costs
+# O(history) Content/Part conversions. Keep live sessions keyed by a
+# client-provided session id, with a TTL and an LRU size cap.
+CHAT_SESSION_CACHE_SIZE = 256
+CHAT_SESSION_TTL_SECONDS = 1800
+_chat_sessions = OrderedDict()
+
+def chat_session_get(session_id: str):
+    """Returns the live ChatSession for the id, or None if absent or expired."""
+    entry = _chat_sessions.get(session_id)
+    if entry is None:
+        return None
+    chat, last_used = entry
+    if time.monotonic() - last_used > CHAT_SESSION_TTL_SECONDS:
+        del _chat_sessions[session_id]
+        return None
+    _chat_sessions[session_id] = (chat, time.monotonic())
+    _chat_sessions.move_to_end(session_id)
+    return chat
+
+def chat_session_put(session_id: str, chat):
+    _chat_sessions[session_id] = (chat, time.monotonic())
+    _chat_sessions.move_to_end(session_id)
+    while len(_chat_sessions) > CHAT_SESSION_CACHE_SIZE:
+        _chat_sessions.popitem(last=False)
+
+# --- Semantic Chat Answer Cache ---
+# Users tend to rephrase the same question about a document. Embed each
+# question (a cheap call next to a full Gemini turn) and serve a cached answer
+# when a previous question for the same document and language is close enough.
+# The key deliberately ignores conversation position: only self-contained
+# questions are cached (see is_cacheable_question), since follow-ups like
+# "explain that more simply" mean different things at different points.
+CHAT_ANSWER_CACHE_DOCS = 64
+CHAT_ANSWERS_PER_DOC = 16
+CHAT_ANSWER_SIM_THRESHOLD = 0.92
+CHAT_ANSWER_MIN_WORDS = 5
+_chat_answers = OrderedDict()
+
+def is_cacheable_question(question: str) -> bool:
+    """Returns whether the question is self-contained enough to cache.
+
+    Very short questions are usually deictic ("why?", "explain that more
+    simply") and depend on context the cache key cannot see.
+    """
+    return len(question.split()) >= CHAT_ANSWER_MIN_WORDS
+
+async def embed_question(question: str):
+    """Returns the question's embedding vector, or None if embedding fails."""
+    try:
+        embeddings = await EMBEDDING_MODEL.get_embeddings_async([question])
+        return embeddings[0].values
+    except Exception as e:
+        print(f"Question embedding error: {e}")
+        return None
+
+def _cosine_similarity(a, b) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm_a = math.sqrt(sum(x * x for x in a))
+    norm_b = math.sqrt(sum(x * x for x in b))
+    if not norm_a or not norm_b:
+        return 0.0
+    return dot / (norm_a * norm_b)
+
+def chat_answer_get(document_sha: str, language: str, question_vec):
+    """Returns a cached answer whose question is semantically close, or None."""
+    entries = _chat_answers.get((document_sha, language))
+    if not entries:
+        return None
+    _chat_answers.move_to_end((document_sha, language))
+    for cached_vec, answer in entries:
+        if _cosine_similarity(cached_vec, question_vec) >= CHAT_ANSWER_SIM_THRESHOLD:
+            return answer
+    return None
+
+def chat_answer_put(document_sha: str, language: str, question_vec, answer: str):
+    entries = _chat_answers.setdefault((document_sha, language), [])
+    _chat_answers.move_to_end((document_sha, language))
+    entries.append((question_vec, answer))
+    if len(entries) > CHAT_ANSWERS_PER_DOC:
+        entries.pop(0)
+    while len(_chat_answers) > CHAT_ANSWER_CACHE_DOCS:
+        _chat_answers.popitem(last=False)
+
+# --- Streaming Helpers ---
+
+async def coalesce(stream, max_chars=4096, max_delay=0.02):
+    """Merges small Gemini chunks into larger ones before they hit the transport.
+
+    Gemini often emits a handful of tokens per chunk; sending each straight to
+    Starlette costs a socket write per chunk. Buffer until ~4 KB or a short
+    deadline, then flush whatever is pending when the stream ends. Expects the
+    async stream returned by generate_content_async(stream=True).
+    """
+    loop = asyncio.get_running_loop()
+    buffer = []
+    buffered_chars = 0
+    last_flush = loop.time()
+    async for chunk in stream:
+        if not hasattr(chunk, 'text'):
+            continue
+        buffer.append(chunk.text)
+        buffered_chars += len(chunk.text)
+        if buffered_chars >= max_chars or loop.time() - last_flush > max_delay:
+            yield "".join(buffer)
+            buffer.clear()
+            buffered_chars = 0
+            last_flush = loop.time()
+    if buffer:
+        yield "".join(buffer)
+
+async def buffered(stream, maxsize=8):
+    """Decouples Gemini production from SSE consumption with explicit backpressure.
+
+    A producer task reads the stream into a bounded queue while the consumer
+    drains it, so generation overlaps with socket writes. When the client is
+    slow the queue fills and the producer blocks on put(), capping buffered
+    memory at maxsize chunks.
+    """
+    queue = asyncio.Queue(maxsize=maxsize)
+
+    async def _pump():
+        try:
+            async for item in stream:
+                await queue.put(item)
+        except asyncio.CancelledError:
+            # The consumer is gone (client disconnect); nobody will drain the
+            # queue, so enqueuing the sentinel here could block forever.
+            raise
+        except BaseException:
+            # Mid-stream error: the consumer is still draining, so a blocking
+            # put is safe and the sentinel lets it reach `await producer`,
+            # which re-raises this exception.
+            await queue.put(None)
+            raise
+        else:
+            await queue.put(None)
+
+    producer = asyncio.create_task(_pump())
+    try:
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            yield item
+        # Surface any exception the producer hit mid-stream.
+        await producer
+    finally:
+        producer.cancel()
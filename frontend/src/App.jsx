@@ -43,16 +43,6 @@ const compressImage = (file, maxWidth = 1024, quality = 0.8) => {
 };
 
 // --- Audio Helper Functions ---
-const base64ToArrayBuffer = (base64) => {
-    const binaryString = window.atob(base64);
-    const len = binaryString.length;
-    const bytes = new Uint8Array(len);
-    for (let i = 0; i < len; i++) {
-        bytes[i] = binaryString.charCodeAt(i);
-    }
-    return bytes.buffer;
-};
-
 const pcmToWav = (pcmData, sampleRate) => {
     const numChannels = 1;
     const bytesPerSample = 2; // 16-bit PCM
@@ -277,9 +267,9 @@ const AudioPlayer = ({ textToSpeak, language, setError }) => {
                 throw new Error(err.detail || "Failed to generate audio.");
             }
 
-            const { audio_data, mime_type } = await response.json();
-            const sampleRate = parseInt(mime_type.match(/rate=(\d+)/)?.[1] || 24000, 10);
-            const pcmBuffer = base64ToArrayBuffer(audio_data);
+            const mimeType = response.headers.get('Content-Type') || 'audio/l16;rate=24000';
+            const sampleRate = parseInt(mimeType.match(/rate=(\d+)/)?.[1] || 24000, 10);
+            const pcmBuffer = await response.arrayBuffer();
             const pcm16 = new Int16Array(pcmBuffer);
             const wavBlob = pcmToWav(pcm16, sampleRate);
             const url = URL.createObjectURL(wavBlob);
@@ -379,6 +369,12 @@ const ChatWindow = ({ originalDocument, analysisText, mdConverter, chatLanguage,
     const [question, setQuestion] = useState('');
     const [isAiTyping, setIsAiTyping] = useState(false);
     const chatContainerRef = useRef(null);
+    const sessionIdRef = useRef(crypto.randomUUID());
+
+    // A fresh document means a fresh server-side chat session.
+    useEffect(() => {
+        sessionIdRef.current = crypto.randomUUID();
+    }, [originalDocument]);
 
     useEffect(() => { 
         if (analysisText && history.length === 0) {
@@ -409,10 +405,11 @@ const ChatWindow = ({ originalDocument, analysisText, mdConverter, chatLanguage,
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify({ 
-                    document: originalDocument, 
-                    history: historyForAPI, 
-                    question: userQuestion, 
-                    language: chatLanguage 
+                    document: originalDocument,
+                    history: historyForAPI,
+                    question: userQuestion,
+                    language: chatLanguage,
+                    session_id: sessionIdRef.current
                 }),
             });
 
@@ -560,10 +557,20 @@ export default function App() {
       if (!response.ok) throw new Error(await response.text() || `HTTP error!`);
       const reader = response.body.getReader();
       const decoder = new TextDecoder();
+      let sseBuffer = '';
       while (true) {
         const { value, done } = await reader.read();
         if (done) break;
-        setAnalysisText(prev => prev + decoder.decode(value, { stream: true }));
+        sseBuffer += decoder.decode(value, { stream: true });
+        const events = sseBuffer.split(/\r?\n\r?\n/);
+        sseBuffer = events.pop();
+        for (const event of events) {
+          const data = event.split(/\r?\n/)
+            .filter((line) => line.startsWith('data:'))
+            .map((line) => line.replace(/^data: ?/, ''))
+            .join('\n');
+          if (data) setAnalysisText(prev => prev + data);
+        }
       }
     } catch (err) {
       setError(`Analysis failed: ${err.message}`);